@@ -6,6 +6,33 @@ import numpy as np
 import yaml
 import urllib.request
 import os
+import re
+import functools
+import copy
+import hashlib
+import pickle
+import glob
+
+try:
+    from yaml import CSafeLoader as _Loader
+except ImportError:
+    from yaml import SafeLoader as _Loader
+
+_CMIPS = frozenset({'cmip5','cmip6'})
+_PATHWAYS = frozenset({'rcp26','rcp45','rcp85','ssp126','ssp245','ssp370','ssp585'})
+_GWLS = frozenset({1.0,1.2,1.5,2.0,3.0,4.0})
+
+# Entries that did not reach a GWL are commented out in the yaml files; uncomment them and flag with 9999
+# (applied to the raw utf-8 bytes so the file is never decoded into an intermediate str; \xc2\xb0 is the degree sign)
+_TIDY_RE = re.compile(rb"# \{|\} -- did not reach [\d.]+\xc2\xb0C")
+
+def _tidy(match):
+    return b"- {" if match.group(0) == b"# {" else b", start_year: 9999, end_year: 9999}"
+
+# Parsed yaml files are pickled here so new sessions can skip the parse. Set GWLS_CACHE_DIR to '' to disable.
+_CACHE_DIR = os.environ.get('GWLS_CACHE_DIR',os.path.join(os.environ.get('XDG_CACHE_HOME',os.path.expanduser('~/.cache')),'gwls'))
+# Part of the cache key; bump whenever the parsed result changes (_TIDY_RE, _tidy, the 9999 sentinel or the loader)
+_CACHE_VERSION = 1
 
 def get_GWL_syear_eyear(CMIP,GCM,ensemble,pathway,GWL):
     """Returns the start and end year of the Global Warming Level timeslice for the specified GWL, GCM, ensemble and pathway.
@@ -33,25 +60,32 @@ def get_GWL_syear_eyear(CMIP,GCM,ensemble,pathway,GWL):
        Start and end year of corresponding 20-year GWL timeslice
     """
 
-    assert CMIP.lower() in ['cmip5','cmip6']
-    assert pathway.lower() in ['rcp26','rcp45','rcp85','ssp126','ssp245','ssp370','ssp585']
-    assert float(GWL) in [1.0,1.2,1.5,2.0,3.0,4.0]
+    cmip = CMIP.lower()
+    if cmip not in _CMIPS:
+        raise ValueError(f"CMIP {CMIP} not recognised. Options are: {sorted(_CMIPS)}")
+    exp = pathway.lower()
+    if exp not in _PATHWAYS:
+        raise ValueError(f"Pathway {pathway} not recognised. Options are: {sorted(_PATHWAYS)}")
+    gwl = float(GWL)
+    if gwl not in _GWLS:
+        raise ValueError(f"GWL {GWL} not recognised. Options are: {sorted(_GWLS)}")
     
-    yaml = read_GWL_yaml_file(CMIP)
-
-    df = pd.json_normalize(yaml,record_path=f'warming_level_{int(float(GWL)*10)}')
+    idx = _get_GWL_index(cmip,int(gwl*10))
 
-    assert GCM in df['model'].unique(), f"Model {model} not recognised. GWLs available for the following models: {df['model'].unique()}"
-        
-    df = df[ (df.model == GCM) & (df.ensemble == ensemble) & (df.exp == pathway) ]
-    if df.empty:
+    years = idx.get((GCM,ensemble,exp))
+    if years is None:
+        models = {key[0] for key in idx}
+        if GCM not in models:
+            raise ValueError(f"Model {GCM} not recognised. GWLs available for the following models: {sorted(models)}")
         raise ValueError(f'GWL {GWL} not calculated for {CMIP,GCM,ensemble,pathway}')
-    elif df.shape[0] > 1:
+    elif len(years) > 1:
         raise ValueError(f'Multiple entries for {CMIP,GCM,ensemble,pathway} GWL {GWL}\N{DEGREE SIGN}C. Check source file.')
-    elif df.end_year.values.flatten() == 9999:
+    
+    syear, eyear = years[0]
+    if eyear == 9999:
         raise ValueError(f'{CMIP,GCM,ensemble,pathway} did not reach GWL {GWL}\N{DEGREE SIGN}C.')
     else:
-        return df[['start_year','end_year']].values.flatten()
+        return syear, eyear
 
 def read_GWL_yaml_file(CMIP):
     """Reads the yaml file from Matthias's repo
@@ -66,27 +100,95 @@ def read_GWL_yaml_file(CMIP):
     Returns
     -------
     yaml : dict
-        yaml file opened in safe mode (effectively a dictionary of dictinaries)
+        yaml file opened in safe mode (effectively a dictionary of dictinaries).
+        A fresh copy of the cached file is returned, so it can be modified without affecting later lookups.
     """
-    
-    repodir = __file__.rsplit('/', 1)[0]
-    fpath = f"{repodir}/cmip_warming_levels/warming_levels/{CMIP.lower()}_all_ens/{CMIP.lower()}_warming_levels_all_ens_1850_1900.yml"
+
+    return copy.deepcopy(_read_GWL_yaml_file(CMIP.lower()))
+
+@functools.lru_cache(maxsize=4)
+def _read_GWL_yaml_file(cmip):
+    """Parses the yaml file for the (lower case) CMIP version. Cached so the file is only read once per session
+    (the result is shared, so internal callers must not modify it), and pickled to the on-disk cache for later sessions."""
+
+    fpath = _GWL_yaml_path(cmip)
+    cache_file = _GWL_cache_file(cmip,fpath)
+    if cache_file is not None:
+        try:
+            with open(cache_file,'rb') as f:
+                return pickle.load(f)
+        except Exception:
+            pass
+
+    yml = _parse_GWL_yaml_file(fpath)
+
+    if cache_file is not None:
+        try:
+            _write_GWL_cache(cache_file,yml)
+        except OSError:
+            pass
+
+    return yml
+
+def _GWL_yaml_path(cmip):
+    """Returns the path of the yaml file for the (lower case) CMIP version in the submodule."""
+
+    repodir = os.path.dirname(os.path.abspath(__file__))
+    fpath = f"{repodir}/cmip_warming_levels/warming_levels/{cmip}_all_ens/{cmip}_warming_levels_all_ens_1850_1900.yml"
     if not os.path.exists(fpath):
         raise ValueError('You have not properly cloned the gwl repository! Go back and use the command \033[1m `git submodule update --init` \033[0m')   
+    return fpath
 
-    with open(fpath) as f:
-        tidied =  (
-            f.read()
-                .replace("# {","- {")
-                .replace("} -- did not reach 1.0°C",", start_year: 9999, end_year: 9999}")
-                .replace("} -- did not reach 1.2°C",", start_year: 9999, end_year: 9999}")
-                .replace("} -- did not reach 1.5°C",", start_year: 9999, end_year: 9999}")
-                .replace("} -- did not reach 2.0°C",", start_year: 9999, end_year: 9999}")
-                .replace("} -- did not reach 3.0°C",", start_year: 9999, end_year: 9999}")
-                .replace("} -- did not reach 4.0°C",", start_year: 9999, end_year: 9999}")
-        )
-    
-        return yaml.safe_load(tidied)
+def _GWL_cache_file(cmip,fpath):
+    """Returns the on-disk cache file for the yaml file, or None if the cache is disabled.
+    Named {cmip}-{path hash}-{key}.pkl, where the key covers _CACHE_VERSION and the file's modification time and size,
+    so that checkouts sharing a cache directory each keep their own file."""
+
+    if not _CACHE_DIR:
+        return None
+    stat = os.stat(fpath)
+    path_hash = hashlib.sha1(os.path.abspath(fpath).encode()).hexdigest()[:12]
+    key = hashlib.sha1(f'{_CACHE_VERSION}:{stat.st_mtime_ns}:{stat.st_size}'.encode()).hexdigest()
+    return os.path.join(_CACHE_DIR,f'{cmip}-{path_hash}-{key}.pkl')
+
+def _parse_GWL_yaml_file(fpath):
+    """Tidies and parses the yaml file."""
+
+    with open(fpath,'rb') as f:
+        return yaml.load(_TIDY_RE.sub(_tidy,f.read()),Loader=_Loader)
+
+def _write_GWL_cache(cache_file,yml):
+    """Pickles the parsed yaml file to cache_file and removes stale cache files for the same CMIP version and checkout. Raises OSError if the write fails."""
+
+    # Write to a temporary file first so concurrent sessions never read a partial pickle
+    tmp_file = f'{cache_file}.{os.getpid()}.tmp'
+    try:
+        os.makedirs(_CACHE_DIR,exist_ok=True)
+        with open(tmp_file,'wb') as f:
+            pickle.dump(yml,f,protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_file,cache_file)
+    except OSError:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        raise
+
+    prefix = os.path.basename(cache_file).rsplit('-',1)[0]
+    for old_file in glob.glob(os.path.join(glob.escape(_CACHE_DIR),f'{prefix}-*.pkl')):
+        if old_file != cache_file:
+            try:
+                os.remove(old_file)
+            except OSError:
+                pass
+
+@functools.lru_cache(maxsize=32)
+def _get_GWL_index(cmip,gwl):
+    """Returns a dictionary mapping (model, ensemble, exp) to a list of (start_year, end_year) for the (lower case) CMIP version and GWL (in tenths of a degree).
+    Built once per (cmip, gwl) so that repeated lookups are a single dictionary access."""
+
+    idx = {}
+    for rec in _read_GWL_yaml_file(cmip)[f'warming_level_{gwl}']:
+        idx.setdefault((rec['model'],rec['ensemble'],rec['exp']),[]).append((rec['start_year'],rec['end_year']))
+    return idx
 
 def get_GWL_lookup_table(CMIP):
     """Reads the yaml file from Matthias's repo and returns as a pandas dataframe
@@ -100,25 +202,19 @@ def get_GWL_lookup_table(CMIP):
 
     Returns
     -------
-    yaml : dict
-        yaml file opened in safe mode (effectively a dictionary of dictinaries)
+    df : pandas DataFrame
+        One row per model, ensemble and pathway for each GWL, with columns model, CMIP, GWL, ensemble, exp, start_year and end_year
     """
 
-    yml = read_GWL_yaml_file(CMIP)
-    appended_df = []
-    for gwl in yml.keys():
-        df = pd.DataFrame(yml[gwl])
-        df.insert(1,'GWL',gwl)
-        df.insert(1,'CMIP',CMIP)
-        appended_df.append(df)
-        del(df)
+    yml = _read_GWL_yaml_file(CMIP.lower())
+    rows = [
+        {'model':rec['model'],'CMIP':CMIP,'GWL':gwl.replace('warming_level_','gwl'),**rec}
+        for gwl,recs in yml.items() for rec in recs
+    ]
     
-    df = pd.concat(appended_df,axis=0,ignore_index=True)
-    df['GWL'] = df['GWL'].str.replace('warming_level_','gwl')
-    
-    return df
+    return pd.DataFrame(rows)
 
-def get_GWL_timeslice(ds,CMIP,GCM,ensemble,pathway,GWL):
+def get_GWL_timeslice(ds,CMIP,GCM,ensemble,pathway,GWL,time_index=None):
     """Returns the 20-year timeslice of a data array corresponding to the desired Global Warming Level.
 
     Author: Mitchell Black (mitchell.black@bom.gov.au)
@@ -137,6 +233,8 @@ def get_GWL_timeslice(ds,CMIP,GCM,ensemble,pathway,GWL):
         Emissions pathway [options: 'rcp26', 'rcp45', 'rcp85', 'ssp126', 'ssp245', 'ssp370', 'ssp585']
     GWL : str or float
         Required Global Warming Level [options: 1.0, 1.2, 1.5, 2.0, 3.0, 4.0]
+    time_index : pandas Index, optional
+        Time index of ds (defaults to ds.indexes['time']). Can be passed when slicing many arrays that share a time axis.
 
     Returns
     -------
@@ -145,4 +243,44 @@ def get_GWL_timeslice(ds,CMIP,GCM,ensemble,pathway,GWL):
     """
 
     syear,eyear = get_GWL_syear_eyear(CMIP,GCM,ensemble,pathway,GWL)
+
+    # For a sorted datetime64 index, locate the slice positions directly rather than through label-based selection.
+    # cftime and unsorted indexes fall back to .sel
+    times = ds.indexes['time'] if time_index is None else time_index
+    if isinstance(times,pd.DatetimeIndex) and times.tz is None and times.is_monotonic_increasing:
+        i0 = times.searchsorted(np.datetime64('{}-01-01'.format(int(syear))))
+        i1 = times.searchsorted(np.datetime64('{}-01-01'.format(int(eyear)+1)))
+        return ds.isel(time=slice(i0,i1))
+
     return ds.sel(time=slice('{}-01-01'.format(int(syear)),'{}-12-31'.format(int(eyear))))
+
+def build_GWL_cache(CMIP=('CMIP5','CMIP6')):
+    """Parses the yaml files from Matthias's repo and writes them to the on-disk cache, so that later sessions skip the yaml parse entirely.
+    Run once after cloning or updating the submodule, e.g. `python gwl.py`. The files are always re-parsed and re-written,
+    and an OSError is raised if the cache cannot be written.
+
+    Parameters
+    ----------
+    CMIP : str or sequence of str
+        Version(s) of CMIP to cache [options: 'CMIP5', 'CMIP6']
+
+    Returns
+    -------
+    cache_dir : str
+        Directory the parsed files were written to
+    """
+
+    if not _CACHE_DIR:
+        raise ValueError('The on-disk cache is disabled (GWLS_CACHE_DIR is empty)')
+
+    for version in ([CMIP] if isinstance(CMIP,str) else CMIP):
+        cmip = version.lower()
+        if cmip not in _CMIPS:
+            raise ValueError(f"CMIP {version} not recognised. Options are: {sorted(_CMIPS)}")
+        fpath = _GWL_yaml_path(cmip)
+        _write_GWL_cache(_GWL_cache_file(cmip,fpath),_parse_GWL_yaml_file(fpath))
+    
+    return _CACHE_DIR
+
+if __name__ == '__main__':
+    print(f'GWL yaml files cached in {build_GWL_cache()}')